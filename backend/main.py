@@ -1,23 +1,41 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, status
+from fastapi import FastAPI, HTTPException, UploadFile, File, Query, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field, validator
+from cachetools import TTLCache
 import clickhouse_connect
+from clickhouse_connect.driver.binding import quote_identifier
+from clickhouse_connect.driver.httputil import get_pool_manager
 from typing import List, Optional
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import asyncio
+import codecs
 import io
+import json
 import logging
+import os
+import queue
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 import re
 
-# Enhanced logging configuration
+# Enhanced logging configuration. Records are formatted on the calling thread
+# and handed to a background listener, so app.log writes never block the event loop.
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.FileHandler('app.log'))
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('app.log'),
+        QueueHandler(log_queue),
         logging.StreamHandler()
     ]
 )
+log_listener.start()
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="ClickHouse Data Ingestion API",
@@ -34,6 +52,26 @@ app.add_middleware(
     expose_headers=["X-Total-Count"]
 )
 
+# Validation patterns, compiled once at import
+HOST_RE = re.compile(r'^[\w\.-]+$')
+IDENTIFIER_RE = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+# One equality in a join condition, e.g. "users.id = orders.user_id"
+JOIN_PAIR_RE = re.compile(
+    r'^\s*([a-zA-Z_][a-zA-Z0-9_]*(?:\.[a-zA-Z_][a-zA-Z0-9_]*)?)\s*=\s*'
+    r'([a-zA-Z_][a-zA-Z0-9_]*(?:\.[a-zA-Z_][a-zA-Z0-9_]*)?)\s*$'
+)
+JOIN_AND_RE = re.compile(r'\s+AND\s+', re.IGNORECASE)
+
+def parse_join_condition(condition: str) -> List[tuple]:
+    """Split "a.x = b.y AND ..." into column pairs; anything else is rejected."""
+    pairs = []
+    for term in JOIN_AND_RE.split(condition):
+        match = JOIN_PAIR_RE.match(term)
+        if not match:
+            raise ValueError('Join condition must be column equalities joined by AND')
+        pairs.append(match.groups())
+    return pairs
+
 # Enhanced data models with validation
 class ClickHouseConnection(BaseModel):
     host: str = Field(..., example="localhost")
@@ -45,7 +83,7 @@ class ClickHouseConnection(BaseModel):
 
     @validator('host')
     def validate_host(cls, v):
-        if not re.match(r'^[\w\.-]+$', v):
+        if not HOST_RE.match(v):
             raise ValueError('Invalid hostname')
         return v
 
@@ -54,38 +92,270 @@ class ColumnSelection(BaseModel):
     columns: List[str] = Field(..., min_items=1)
     join_tables: Optional[List[str]] = Field(None)
     join_condition: Optional[str] = Field(None)
+    limit: Optional[int] = Field(None, gt=0)
+    # X-Total-Count on exports costs a second run of the whole query, so it's opt-in
+    include_count: bool = Field(False)
 
     @validator('table', 'join_tables', each_item=True)
     def validate_table_names(cls, v):
-        if not re.match(r'^[a-zA-Z_][a-zA-Z0-9_]*$', v):
+        if not IDENTIFIER_RE.match(v):
             raise ValueError('Invalid table name')
         return v
 
-# Database connection pool
+    @validator('join_condition')
+    def validate_join_condition(cls, v):
+        if v is not None:
+            parse_join_condition(v)
+        return v
+
+# Database connection pool. Clients share one urllib3 pool manager so
+# keep-alive connections are reused across requests and databases.
+MAX_POOL_SIZE = 16
+http_pool = get_pool_manager(num_pools=8, maxsize=MAX_POOL_SIZE)
 connection_pool = {}
+# One creation lock per connection key, so a hung host only holds up its own callers
+connection_locks = {}
 
-def get_client(conn: ClickHouseConnection):
-    cache_key = f"{conn.host}:{conn.port}:{conn.database}:{conn.username}"
-    if cache_key not in connection_pool:
-        try:
-            connection_pool[cache_key] = clickhouse_connect.get_client(
-                host=conn.host,
-                port=conn.port,
-                username=conn.username,
-                password=conn.password,
-                database=conn.database,
-                secure=conn.secure,
-                connect_timeout=10,
-                query_limit=0
-            )
-        except Exception as e:
-            logger.error(f"Connection failed: {str(e)}")
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="Database connection failed"
-            )
+# Table schemas change rarely; cache column listings per connection for a minute
+schema_cache = TTLCache(maxsize=1024, ttl=60)
+
+def quote_column(name: str) -> str:
+    """Quote a possibly table-qualified column name, e.g. users.id -> `users`.`id`."""
+    return ".".join(quote_identifier(part) for part in name.split("."))
+
+def connection_key(conn: ClickHouseConnection) -> str:
+    return f"{conn.host}:{conn.port}:{conn.database}:{conn.username}"
+
+async def get_client(conn: ClickHouseConnection):
+    cache_key = connection_key(conn)
+    if cache_key in connection_pool:
+        return connection_pool[cache_key]
+    async with connection_locks.setdefault(cache_key, asyncio.Lock()):
+        # Another request may have created the client while we waited
+        if cache_key not in connection_pool:
+            try:
+                connection_pool[cache_key] = await asyncio.to_thread(
+                    clickhouse_connect.get_client,
+                    host=conn.host,
+                    port=conn.port,
+                    username=conn.username,
+                    password=conn.password,
+                    database=conn.database,
+                    secure=conn.secure,
+                    connect_timeout=10,
+                    query_limit=0,
+                    pool_mgr=http_pool,
+                    # Sessions serialize requests; concurrent batch inserts need them off
+                    autogenerate_session_id=False
+                )
+            except Exception as e:
+                logger.error(f"Connection failed: {str(e)}")
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Database connection failed"
+                )
     return connection_pool[cache_key]
 
+# Worker threads for blocking driver/parser calls, so they don't stall the event loop
+BLOCKING_WORKERS = 8
+
+# Arrow -> ClickHouse column types for imported CSVs; anything unlisted becomes String
+ARROW_TO_CLICKHOUSE = {
+    pa.int8(): 'Int8',
+    pa.int16(): 'Int16',
+    pa.int32(): 'Int32',
+    pa.int64(): 'Int64',
+    pa.uint8(): 'UInt8',
+    pa.uint16(): 'UInt16',
+    pa.uint32(): 'UInt32',
+    pa.uint64(): 'UInt64',
+    pa.float32(): 'Float32',
+    pa.float64(): 'Float64',
+    pa.bool_(): 'UInt8',
+    pa.date32(): 'Date32',
+    pa.timestamp('s'): 'DateTime64(0)',
+    pa.timestamp('ms'): 'DateTime64(3)',
+    pa.timestamp('us'): 'DateTime64(6)',
+    pa.timestamp('ns'): 'DateTime64(9)',
+    pa.string(): 'String',
+    pa.large_string(): 'String'
+}
+
+def is_temporal(arrow_type) -> bool:
+    return pa.types.is_timestamp(arrow_type) or pa.types.is_date(arrow_type)
+
+def mergetree_keys(schema, order_by: Optional[List[str]], partition_by: Optional[str]) -> str:
+    """Build the PARTITION BY / ORDER BY clauses for an imported table.
+
+    Without an explicit order_by, order by the first integer or date/time column
+    so later queries can skip granules instead of scanning an unordered table.
+    Partitioning is opt-in: partition_by must be a date/time column and is
+    partitioned by month, since raw values would create a part per distinct
+    value. Even monthly partitions can trip max_partitions_per_insert_block
+    when one batch spans many years, so none is added by default.
+    """
+    unknown = [c for c in (order_by or []) + [partition_by] if c and c not in schema.names]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown key columns: {', '.join(unknown)}"
+        )
+    if partition_by and not is_temporal(schema.field(partition_by).type):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"partition_by must be a date/time column: {partition_by}"
+        )
+    
+    if order_by is None:
+        order_by = [field.name for field in schema
+                    if pa.types.is_integer(field.type) or is_temporal(field.type)][:1]
+    
+    clauses = []
+    if partition_by:
+        clauses.append(f"PARTITION BY toYYYYMM({quote_identifier(partition_by)})")
+    if order_by:
+        clauses.append(f"ORDER BY ({', '.join(quote_identifier(c) for c in order_by)})")
+    else:
+        clauses.append("ORDER BY tuple()")
+    
+    # Non-String imported columns are Nullable, which MergeTree keys must opt into
+    key_columns = set(order_by) | ({partition_by} - {None})
+    if any(ARROW_TO_CLICKHOUSE.get(schema.field(c).type, 'String') != 'String' for c in key_columns):
+        clauses.append("SETTINGS allow_nullable_key = 1")
+    return " ".join(clauses)
+
+# Upload spooling: read the request body in 1 MiB chunks, spill to disk past 64 MiB,
+# and let pyarrow pull the spool back in 4 MiB blocks
+UPLOAD_CHUNK_SIZE = 1 << 20
+SPOOL_MAX_SIZE = 64 << 20
+CSV_READ_BLOCK_SIZE = 4 << 20
+
+def iter_table_batches(reader, batch_size: int):
+    """Regroup a CSV streaming reader's blocks into tables of exactly batch_size rows.
+
+    Blocks are merged or split as needed (zero-copy); only the last table may be short.
+    """
+    pending = None
+    for record_batch in reader:
+        block = pa.Table.from_batches([record_batch])
+        pending = block if pending is None else pa.concat_tables([pending, block])
+        while pending.num_rows >= batch_size:
+            yield pending.slice(0, batch_size)
+            pending = pending.slice(batch_size)
+    if pending is not None and pending.num_rows:
+        yield pending
+
+def infer_column_types(spooled, read_options, parse_options) -> dict:
+    """Infer column types from the whole spooled CSV, not just its first block.
+
+    pyarrow guesses types from the first block; every block is then re-read as
+    strings and any column whose values don't cast to the guess falls back to
+    string, so the import can't fail on a stray value halfway through.
+    """
+    spooled.seek(0)
+    schema = pa_csv.open_csv(
+        pa.PythonFile(spooled, mode='r'),
+        read_options=read_options,
+        parse_options=parse_options
+    ).schema
+    # All-empty columns infer as null, and unmapped types would land in String columns
+    column_types = {
+        field.name: field.type if field.type in ARROW_TO_CLICKHOUSE else pa.string()
+        for field in schema
+    }
+    
+    spooled.seek(0)
+    reader = pa_csv.open_csv(
+        pa.PythonFile(spooled, mode='r'),
+        read_options=read_options,
+        parse_options=parse_options,
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: pa.string() for name in column_types},
+            strings_can_be_null=True
+        )
+    )
+    for record_batch in reader:
+        for name, arrow_type in column_types.items():
+            if arrow_type == pa.string():
+                continue
+            try:
+                pc.cast(record_batch.column(name), arrow_type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                column_types[name] = pa.string()
+    return column_types
+
+# CSV export encoder: "pyarrow" (default, vectorized C++) or "pandas" (compatibility)
+CSV_ENGINE = os.getenv("CSV_ENGINE", "pyarrow")
+
+# Server-side guards for exports; blocks match the CSV encoder batch size
+EXPORT_BLOCK_SIZE = 65536
+EXPORT_SETTINGS = {
+    'max_memory_usage': 8 << 30,
+    'max_execution_time': 300,
+    'max_block_size': EXPORT_BLOCK_SIZE
+}
+
+# Encoded CSV is coalesced into ~1 MiB response chunks instead of one write per block
+EXPORT_BUFFER_SIZE = 1 << 20
+
+def stringify_nested(batch):
+    """Render list/struct/map columns (Array, Tuple, Map) as JSON text for write_csv."""
+    if not any(pa.types.is_nested(field.type) for field in batch.schema):
+        return batch
+    columns = [
+        pa.array(
+            [None if value is None else json.dumps(value, default=str) for value in column.to_pylist()],
+            pa.string()
+        ) if pa.types.is_nested(column.type) else column
+        for column in batch.columns
+    ]
+    return pa.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+def write_csv_header(buffer, columns: List[str]):
+    """Header-only CSV for exports that return no rows."""
+    empty = pa.Table.from_arrays([pa.array([], pa.string()) for _ in columns], names=columns)
+    pa_csv.write_csv(empty, buffer)
+
+def arrow_csv_chunks(stream, columns: List[str]):
+    """Serialize Arrow blocks as they arrive; only the first one carries the header."""
+    # UTF-8 with BOM, so spreadsheet tools detect the encoding
+    buffer = io.BytesIO(codecs.BOM_UTF8)
+    buffer.seek(0, io.SEEK_END)
+    include_header = True
+    with stream:
+        for batch in stream:
+            pa_csv.write_csv(
+                stringify_nested(batch),
+                buffer,
+                write_options=pa_csv.WriteOptions(include_header=include_header, batch_size=EXPORT_BLOCK_SIZE)
+            )
+            include_header = False
+            if buffer.tell() >= EXPORT_BUFFER_SIZE:
+                # A fresh buffer per chunk lets getvalue() hand over its bytes without copying
+                yield buffer.getvalue()
+                buffer = io.BytesIO()
+    if include_header:
+        write_csv_header(buffer, columns)
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def pandas_csv_chunks(stream, columns: List[str]):
+    """Same as arrow_csv_chunks, but for DataFrame blocks encoded with DataFrame.to_csv."""
+    buffer = io.BytesIO(codecs.BOM_UTF8)
+    buffer.seek(0, io.SEEK_END)
+    include_header = True
+    with stream:
+        for df in stream:
+            df.to_csv(buffer, index=False, header=include_header, chunksize=EXPORT_BLOCK_SIZE)
+            include_header = False
+            if buffer.tell() >= EXPORT_BUFFER_SIZE:
+                yield buffer.getvalue()
+                buffer = io.BytesIO()
+    if include_header:
+        write_csv_header(buffer, columns)
+    if buffer.tell():
+        yield buffer.getvalue()
+
 @app.post("/connect-clickhouse", 
           response_model=dict,
           responses={
@@ -96,10 +366,12 @@ def get_client(conn: ClickHouseConnection):
 async def connect_clickhouse(conn: ClickHouseConnection):
     try:
         logger.info(f"Connection attempt to {conn.host}:{conn.port}")
-        client = get_client(conn)
+        client = await get_client(conn)
         
         # Test connection with lightweight query
-        tables = client.query('SHOW TABLES', settings={'max_result_rows': 1000})
+        tables = await asyncio.to_thread(
+            client.query, 'SHOW TABLES', settings={'max_result_rows': 1000}
+        )
         table_names = [table[0] for table in tables.result_rows]
         
         logger.info(f"Found {len(table_names)} tables")
@@ -128,28 +400,35 @@ async def connect_clickhouse(conn: ClickHouseConnection):
 async def get_columns(conn: ClickHouseConnection, table: str):
     try:
         logger.info(f"Fetching columns for table {table}")
-        client = get_client(conn)
-        
-        # Validate table exists first
-        exists = client.query(f"EXISTS TABLE {table}").result_rows[0][0]
-        if not exists:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Table {table} does not exist"
-            )
-            
-        columns = client.query(f"DESCRIBE TABLE {table}").result_rows
-        column_info = [{
-            "name": col[0],
-            "type": col[1],
-            "default": col[2],
-            "comment": col[3]
-        } for col in columns]
+        schema_key = (connection_key(conn), table)
+        column_info = schema_cache.get(schema_key)
+        if column_info is None:
+            client = await get_client(conn)
+            # One parameterized round-trip; no rows means the table doesn't exist
+            columns = (await asyncio.to_thread(
+                client.query,
+                "SELECT name, type, default_expression, comment FROM system.columns "
+                "WHERE database = {database:String} AND table = {table:String} "
+                "ORDER BY position",
+                parameters={"database": conn.database, "table": table}
+            )).result_rows
+            if not columns:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Table {table} does not exist"
+                )
+            column_info = [{
+                "name": col[0],
+                "type": col[1],
+                "default": col[2],
+                "comment": col[3]
+            } for col in columns]
+            schema_cache[schema_key] = column_info
         
         return {
             "status": "success",
             "columns": column_info,
-            "count": len(columns)
+            "count": len(column_info)
         }
     except HTTPException:
         raise
@@ -161,45 +440,52 @@ async def get_columns(conn: ClickHouseConnection, table: str):
         )
 
 @app.post("/clickhouse-to-flatfile",
-          response_model=dict,
+          response_class=StreamingResponse,
           responses={
-              200: {"description": "Data exported successfully"},
+              200: {"description": "Data exported successfully", "content": {"text/csv": {}}},
               400: {"description": "Invalid query parameters"},
               500: {"description": "Export failed"}
           })
 async def clickhouse_to_flatfile(conn: ClickHouseConnection, selection: ColumnSelection):
     try:
         logger.info(f"Export request for table {selection.table}")
-        client = get_client(conn)
+        client = await get_client(conn)
         
-        # Build safe query
-        query = f"SELECT {', '.join(selection.columns)} FROM {selection.table}"
+        # Build safe query: every identifier is quoted, so column names can't smuggle SQL
+        columns_str = ", ".join(quote_column(col) for col in selection.columns)
+        query = f"SELECT {columns_str} FROM {quote_identifier(selection.table)}"
         
         if selection.join_tables and selection.join_condition:
-            tables_str = ", ".join([selection.table] + selection.join_tables)
-            query = f"SELECT {', '.join(selection.columns)} FROM {tables_str} WHERE {selection.join_condition}"
-        
-        logger.info(f"Executing query: {query[:200]}...")  # Log truncated query
-        result = client.query(query)
+            tables_str = ", ".join(quote_identifier(t) for t in [selection.table] + selection.join_tables)
+            join_predicate = " AND ".join(
+                f"{quote_column(left)} = {quote_column(right)}"
+                for left, right in parse_join_condition(selection.join_condition)
+            )
+            query = f"SELECT {columns_str} FROM {tables_str} WHERE {join_predicate}"
         
-        if not result.result_rows:
-            return {
-                "status": "success",
-                "data": "",
-                "count": 0,
-                "message": "No data found"
-            }
-            
-        df = pd.DataFrame(result.result_rows, columns=selection.columns)
-        csv_data = df.to_csv(index=False, encoding='utf-8-sig')  # UTF-8 with BOM
+        settings = dict(EXPORT_SETTINGS)
+        if selection.limit:
+            query += f" LIMIT {selection.limit}"
+            settings['max_result_rows'] = selection.limit
         
-        return {
-            "status": "success",
-            "data": csv_data,
-            "count": len(result.result_rows),
-            "query": query,
-            "exported_at": datetime.now().isoformat()
-        }
+        logger.info(f"Executing query: {query[:200]}...")  # Log truncated query
+        filename = f"{selection.table}_{datetime.now():%Y%m%d_%H%M%S}.csv"
+        headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+        if selection.include_count:
+            # Headers go out before the body, so the count is a separate query
+            # and may drift from the streamed rows if the table changes meanwhile
+            headers["X-Total-Count"] = str(await asyncio.to_thread(
+                client.command, f"SELECT count() FROM ({query})", settings=EXPORT_SETTINGS
+            ))
+        if CSV_ENGINE == "pandas":
+            # query_df_stream builds DataFrame columns straight from the native blocks
+            stream = await asyncio.to_thread(client.query_df_stream, query, settings=settings)
+            csv_chunks = pandas_csv_chunks(stream, selection.columns)
+        else:
+            stream = await asyncio.to_thread(
+                client.query_arrow_stream, query, settings=settings, use_strings=True
+            )
+            csv_chunks = arrow_csv_chunks(stream, selection.columns)
     except Exception as e:
         logger.error(f"Export error: {str(e)}")
         raise HTTPException(
@@ -207,6 +493,8 @@ async def clickhouse_to_flatfile(conn: ClickHouseConnection, selection: ColumnSe
             detail=f"Export failed: {str(e)}"
         )
 
+    return StreamingResponse(csv_chunks, media_type="text/csv", headers=headers)
+
 @app.post("/flatfile-to-clickhouse",
           response_model=dict,
           responses={
@@ -218,11 +506,20 @@ async def flatfile_to_clickhouse(
     conn: ClickHouseConnection,
     file: UploadFile = File(...),
     table: str = "imported_data",
-    delimiter: str = ","
+    delimiter: str = ",",
+    batch_size: int = Query(100_000, gt=0),
+    order_by: Optional[List[str]] = Query(None),
+    partition_by: Optional[str] = None
 ):
     try:
         logger.info(f"Import request for file {file.filename}")
         
+        if not IDENTIFIER_RE.match(table):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Invalid table name"
+            )
+        
         # Validate file type
         if not file.filename.lower().endswith(('.csv', '.txt')):
             raise HTTPException(
@@ -230,65 +527,114 @@ async def flatfile_to_clickhouse(
                 detail="Only CSV files are supported"
             )
         
-        contents = await file.read()
-        df = pd.read_csv(
-            io.StringIO(contents.decode('utf-8')),
-            delimiter=delimiter,
-            dtype=str,
-            na_filter=False
-        )
-        
-        if df.empty:
+        if len(delimiter) != 1:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
-                detail="File is empty or invalid format"
+                detail="Delimiter must be a single character"
             )
         
-        client = get_client(conn)
-        
-        # Enhanced schema detection
-        type_mapping = {
-            'int64': 'Int64',
-            'float64': 'Float64',
-            'bool': 'UInt8',
-            'datetime64': 'DateTime',
-            'object': 'String'
-        }
-        
-        columns_def = []
-        for col, dtype in df.dtypes.items():
-            ch_type = type_mapping.get(str(dtype), 'String')
-            columns_def.append(f"`{col}` {ch_type}")
-        
-        create_table_sql = (
-            f"CREATE TABLE IF NOT EXISTS `{table}` "
-            f"({', '.join(columns_def)}) "
-            f"ENGINE = MergeTree() "
-            f"ORDER BY tuple()"
-        )
-        
-        logger.info(f"Creating table: {create_table_sql}")
-        client.command(create_table_sql)
-        
-        # Batch insert for large files
-        batch_size = 10000
-        total_rows = len(df)
-        inserted_rows = 0
-        
-        for i in range(0, total_rows, batch_size):
-            batch = df.iloc[i:i + batch_size]
-            client.insert(
-                table,
-                batch.values.tolist(),
-                column_names=batch.columns.tolist()
+        # Spool the upload in chunks (RAM up to SPOOL_MAX_SIZE, disk beyond)
+        # and parse it block by block instead of holding the whole body
+        spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        try:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(spooled.write, chunk)
+            
+            read_options = pa_csv.ReadOptions(block_size=CSV_READ_BLOCK_SIZE)
+            parse_options = pa_csv.ParseOptions(delimiter=delimiter)
+            try:
+                # Settle column types over the whole file before the table exists
+                column_types = await asyncio.to_thread(
+                    infer_column_types, spooled, read_options, parse_options
+                )
+                spooled.seek(0)
+                reader = await asyncio.to_thread(
+                    pa_csv.open_csv,
+                    pa.PythonFile(spooled, mode='r'),
+                    read_options=read_options,
+                    parse_options=parse_options,
+                    convert_options=pa_csv.ConvertOptions(column_types=column_types)
+                )
+                batches = iter_table_batches(reader, batch_size)
+                first_batch = await asyncio.to_thread(next, batches, None)
+            except pa.ArrowInvalid as e:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"File is empty or invalid format: {str(e)}"
+                )
+            
+            if first_batch is None:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="File is empty or invalid format"
+                )
+            
+            client = await get_client(conn)
+            
+            # Missing values anywhere in the file become NULL, so keep
+            # non-string columns Nullable
+            columns_def = []
+            for field in reader.schema:
+                ch_type = ARROW_TO_CLICKHOUSE.get(field.type, 'String')
+                if ch_type != 'String':
+                    ch_type = f"Nullable({ch_type})"
+                columns_def.append(f"{quote_identifier(field.name)} {ch_type}")
+            
+            create_table_sql = (
+                f"CREATE TABLE IF NOT EXISTS {quote_identifier(table)} "
+                f"({', '.join(columns_def)}) "
+                f"ENGINE = MergeTree() "
+                f"{mergetree_keys(reader.schema, order_by, partition_by)}"
             )
-            inserted_rows += len(batch)
-            logger.info(f"Inserted {inserted_rows}/{total_rows} rows")
+            
+            logger.info(f"Creating table: {create_table_sql}")
+            await asyncio.to_thread(client.command, create_table_sql)
+            
+            # Batch insert for large files. MergeTree prefers few large parts, and
+            # keeping two inserts in flight overlaps parsing the next batch with
+            # sending the previous one.
+            inserted_rows = 0
+            in_flight = asyncio.Semaphore(2)
+            
+            async def insert_batch(batch):
+                nonlocal inserted_rows
+                try:
+                    await asyncio.to_thread(client.insert_arrow, table, batch)
+                finally:
+                    in_flight.release()
+                inserted_rows += batch.num_rows
+                logger.info(f"Inserted {inserted_rows} rows")
+            
+            insert_tasks = []
+            try:
+                try:
+                    batch = first_batch
+                    while batch is not None:
+                        await in_flight.acquire()
+                        # Surface a failed insert before parsing and submitting more batches
+                        finished = [task for task in insert_tasks if task.done()]
+                        insert_tasks = [task for task in insert_tasks if not task.done()]
+                        for task in finished:
+                            task.result()
+                        insert_tasks.append(asyncio.create_task(insert_batch(batch)))
+                        batch = await asyncio.to_thread(next, batches, None)
+                    await asyncio.gather(*insert_tasks)
+                finally:
+                    # An insert already running in a worker thread can't be interrupted,
+                    # so wait for in-flight ones rather than letting them outlive the response
+                    await asyncio.gather(*insert_tasks, return_exceptions=True)
+            except pa.ArrowInvalid as e:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=f"Invalid value after {inserted_rows} rows were inserted: {str(e)}"
+                )
+        finally:
+            spooled.close()
         
         return {
             "status": "success",
             "count": inserted_rows,
-            "columns": df.columns.tolist(),
+            "columns": reader.schema.names,
             "table": table,
             "imported_at": datetime.now().isoformat()
         }
@@ -301,6 +647,22 @@ async def flatfile_to_clickhouse(
             detail=f"Import failed: {str(e)}"
         )
 
+HEALTH_CHECK_TIMEOUT = 2
+health_client_lock = asyncio.Lock()
+
+def create_health_client():
+    return clickhouse_connect.get_client(
+        host='localhost',
+        port=8123,
+        username='default',
+        password='',
+        connect_timeout=HEALTH_CHECK_TIMEOUT,
+        # Bound the worker thread too; wait_for alone leaves it blocked on a hung server
+        send_receive_timeout=HEALTH_CHECK_TIMEOUT,
+        pool_mgr=http_pool,
+        autogenerate_session_id=False
+    )
+
 @app.get("/health",
          response_model=dict,
          responses={
@@ -309,15 +671,17 @@ async def flatfile_to_clickhouse(
          })
 async def health_check():
     try:
-        # Test a minimal ClickHouse connection
-        test_client = clickhouse_connect.get_client(
-            host='localhost',
-            port=8123,
-            username='default',
-            password='',
-            connect_timeout=2
+        # Ping over the long-lived health client; it is created here only if
+        # ClickHouse was unreachable at startup
+        if app.state.health_client is None:
+            async with health_client_lock:
+                # Concurrent probes must not each create (and leak) a client
+                if app.state.health_client is None:
+                    app.state.health_client = await asyncio.to_thread(create_health_client)
+        await asyncio.wait_for(
+            asyncio.to_thread(app.state.health_client.command, 'SELECT 1'),
+            timeout=HEALTH_CHECK_TIMEOUT
         )
-        test_client.command('SELECT 1')
         return {
             "status": "healthy",
             "timestamp": datetime.now().isoformat(),
@@ -333,8 +697,38 @@ async def health_check():
             detail=f"Service unavailable: {str(e)}"
         )
 
+@app.on_event("startup")
+async def startup_event():
+    # Blocking ClickHouse and pyarrow calls run via asyncio.to_thread
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_WORKERS)
+    )
+    app.state.health_client = None
+    try:
+        app.state.health_client = await asyncio.to_thread(create_health_client)
+    except Exception as e:
+        logger.warning(f"Health check client not created at startup: {str(e)}")
+
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("Shutting down - closing database connections")
     for client in connection_pool.values():
-        client.close()
\ No newline at end of file
+        client.close()
+    if app.state.health_client is not None:
+        app.state.health_client.close()
+    http_pool.clear()
+    log_listener.stop()
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvloop/httptools keep multipart upload reads out of Python-level socket
+    # code; several workers stop CSV parsing in one request starving uploads.
+    uvicorn.run(
+        "main:app",
+        host="127.0.0.1",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=4
+    )